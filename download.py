@@ -1,14 +1,20 @@
 import ee
 import os
 import sys
-import requests
+from download_utils import (
+    init_ee, make_session, stream_to_file, AdaptiveLimiter,
+    url_rejected, retry_wait, fetch_features, get_download_url, log_download_host
+)
 import rasterio
-import multiprocessing
+from shapely.geometry import shape
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import time
+import threading
 import logging
 from functools import partial
 import json
+import re
 
 # ========== Logging Setup ==========
 class RedFormatter(logging.Formatter):
@@ -43,6 +49,7 @@ COUNTRY_NAME = config.get('COUNTRY_NAME') or sys.exit("COUNTRY_NAME missing in c
 SOUTH = config.get('SOUTH', False)
 MAX_RETRIES = config.get('MAX_RETRIES', 5)
 BASE_WAIT = config.get('BASE_WAIT', 2.0)
+MAX_WORKERS = config.get('MAX_WORKERS', 32)
 
 START_DATE = config['START_DATE']
 YEAR = START_DATE[:4]
@@ -60,56 +67,107 @@ for chunk_name, band_indices in raw_chunks.items():
     CHUNKS[chunk_name] = [f"A{i:02d}" for i in band_indices]
 
 # ========== Earth Engine Init ==========
-try:
-    ee.Initialize()
-except ee.EEException:
-    ee.Authenticate()
-    ee.Initialize()
+init_ee()
+
+# ========== HTTP Session / Throttling ==========
+_SESSION = make_session(MAX_WORKERS)
+_LIMITER = AdaptiveLimiter(MAX_WORKERS)
 
 # ========== Get Embedding Image with Label ==========
+# Built once for all bands so every tile and band chunk shares the same
+# server-side graph; chunks only differ by a final select().
+EMBEDDING_MEAN = ee.ImageCollection("GOOGLE/SATELLITE_EMBEDDING/V1/ANNUAL") \
+    .filter(ee.Filter.calendarRange(int(YEAR), int(YEAR), 'year')) \
+    .mean() \
+    .multiply(10000).toInt16()
+
+WETLAND_LABEL = ee.Image("projects/ee-gmkovacs/assets/ext_wetland_2018_v2021_nw") \
+    .select([0], ['wetland_label']) \
+    .toInt16()
+
 def get_embedding_image(feature, epsg, band_list, include_label=True):
     geometry = feature.geometry()
 
-    collection = ee.ImageCollection("GOOGLE/SATELLITE_EMBEDDING/V1/ANNUAL") \
-        .filter(ee.Filter.calendarRange(int(YEAR), int(YEAR), 'year'))
-
-    embedding = collection.select(band_list).mean() \
-        .clip(geometry) \
-        .multiply(10000).toInt16()
+    embedding = EMBEDDING_MEAN.select(band_list).clip(geometry)
 
     if include_label:
-        label = ee.Image("projects/ee-gmkovacs/assets/ext_wetland_2018_v2021_nw") \
-            .clip(geometry) \
-            .select([0], ['wetland_label']) \
-            .toInt16()
+        label = WETLAND_LABEL.clip(geometry)
         return label.addBands(embedding), epsg
     else:
         return embedding, epsg
 
 
+# ========== UTM Helpers ==========
+def utm_epsg(feature_dict):
+    # Computed locally from the GeoJSON geometry to avoid a getInfo() per tile.
+    # This only works for lon/lat coordinates, so refuse anything projected.
+    geometry = feature_dict['geometry']
+    if 'crs' in geometry or 'crs' in feature_dict:
+        raise ValueError(f"Expected EPSG:4326 geometry, got projected crs in {GRID_ASSET}")
+    centroid = shape(geometry).centroid
+    lon, lat = centroid.x, centroid.y
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        raise ValueError(f"Centroid ({lon}, {lat}) is not lon/lat; check the CRS of {GRID_ASSET}")
+    zone = int((lon + 180) // 6) + 1
+    return (32700 if lat < 0 else 32600) + zone
+
+
+# ========== Resume Marker ==========
+LAST_INDEX_FILE = "_last_index"
+_PROGRESS_LOCK = threading.Lock()
+_progress = {}
+
+def read_last_index(out_dir, chunk_name):
+    try:
+        with open(os.path.join(out_dir, LAST_INDEX_FILE), 'r') as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        # No marker yet: fall back to a single scan of the directory
+        tile_re = re.compile(
+            rf"google_embed_{re.escape(COUNTRY_NAME)}_{YEAR}_{RES}m_\d+_{re.escape(chunk_name)}_(?P<index>\d+)\.tif$"
+        )
+        matches = (tile_re.match(entry.name) for entry in os.scandir(out_dir))
+        return max((int(m.group('index')) for m in matches if m), default=-1)
+
+def start_progress(out_dir, last_index):
+    with _PROGRESS_LOCK:
+        _progress[out_dir] = {'last': last_index, 'done': set()}
+
+def mark_done(out_dir, i):
+    # Tiles finish out of order; only advance over a contiguous run so a
+    # resumed run never skips a tile that had not finished yet.
+    with _PROGRESS_LOCK:
+        state = _progress[out_dir]
+        state['done'].add(i)
+        last = state['last']
+        while last + 1 in state['done']:
+            last += 1
+            state['done'].discard(last)
+        if last == state['last']:
+            return
+        state['last'] = last
+        marker = os.path.join(out_dir, LAST_INDEX_FILE)
+        with open(marker + ".tmp", 'w') as f:
+            f.write(str(last))
+        os.replace(marker + ".tmp", marker)
+
+
 # ========== Download Function ==========
 def check_and_download(params):
-    i, feature_obj, band_list, chunk_name = params
-    feat = ee.Feature(feature_obj)
-
-    centroid = feat.geometry().centroid(1)
-    lon = centroid.coordinates().get(0)
-    lat = centroid.coordinates().get(1)
-    utm_zone = ee.Number(lon).add(180).divide(6).floor().add(1)
-    is_southern = ee.Number(lat).lt(0)
-    epsg_code = ee.Algorithms.If(is_southern, ee.Number(32700).add(utm_zone), ee.Number(32600).add(utm_zone))
-    epsg = int(ee.Number(epsg_code).getInfo())
+    i, feature_obj, epsg, band_list, chunk_name = params
 
+    # The EPSG is known locally, so resuming costs only a stat() per done tile;
+    # out_dir is created by main() before any tiles are submitted.
     out_dir = os.path.join(OUTPUT_DIR, COUNTRY_NAME, YEAR, chunk_name)
-    os.makedirs(out_dir, exist_ok=True)
     filename = f"google_embed_{COUNTRY_NAME}_{YEAR}_{RES}m_{epsg}_{chunk_name}_{i}.tif"
     outp = os.path.join(out_dir, filename)
 
     if os.path.exists(outp):
+        mark_done(out_dir, i)
         return None
 
     try:
-        feature = feat.transform(f"EPSG:{epsg}", 0.001)
+        feature = ee.Feature(feature_obj)
         include_label = chunk_name == "bands_00_21"
         img, epsg = get_embedding_image(feature, epsg, band_list, include_label=include_label)
 
@@ -117,36 +175,42 @@ def check_and_download(params):
         logging.error(f"[{i}] Failed to get embedding image: {e}")
         return None
 
+    # Write to a .part file so an interrupted download never looks complete
+    part = outp + ".part"
+    url = None
     for attempt in range(MAX_RETRIES):
+        _LIMITER.acquire()
         try:
-            img_utm = img.reproject(f"EPSG:{epsg}", None, RES)
-            url = img_utm.getDownloadURL({
-                'region': feature.geometry(),
-                'scale': RES,
-                'format': 'GEO_TIFF'
-            })
-            r = requests.get(url, timeout=300)
-            r.raise_for_status()
-            with open(outp, 'wb') as f:
-                f.write(r.content)
-
-            with rasterio.open(outp, 'r+') as dst:
-                if chunk_name == "bands_00_21":
-                    dst.set_band_description(1, "wetland_label")
-                    for band_idx, original_index in enumerate(band_list, start=2):
-                        dst.set_band_description(band_idx, f"embedding_{int(original_index[1:])}")
-                else:
-                    for band_idx, original_index in enumerate(band_list, start=1):
-                        dst.set_band_description(band_idx, f"embedding_{int(original_index[1:])}")
+            if url is None:
+                url = get_download_url(img, feature, epsg, RES)
+                log_download_host(url)
+            stream_to_file(_SESSION, url, part)
+
+            descriptions = [f"embedding_{int(original_index[1:])}" for original_index in band_list]
+            if chunk_name == "bands_00_21":
+                descriptions.insert(0, "wetland_label")
+            with rasterio.open(part, 'r+', sharing=False) as dst:
+                dst.descriptions = tuple(descriptions)
+            os.replace(part, outp)
 
             if i == 0:
                 with open(os.path.join(out_dir, "bands_used.txt"), "w") as f:
                     f.write("\n".join(band_list))
 
+            _LIMITER.succeeded()
+            mark_done(out_dir, i)
             return outp
         except Exception as e:
+            if os.path.exists(part):
+                os.remove(part)
+            if url_rejected(e):
+                # The server rejected the URL (e.g. it expired); request a fresh one
+                url = None
             logging.warning(f"[{i}] Retry {attempt+1}/{MAX_RETRIES} failed: {e}")
-            time.sleep(BASE_WAIT * (2**attempt))
+            wait = retry_wait(e, attempt, _LIMITER, BASE_WAIT, MAX_RETRIES)
+        finally:
+            _LIMITER.release()
+        time.sleep(wait)
 
     logging.error(f"[{i}] Failed to download after {MAX_RETRIES} retries: {filename}")
     return None
@@ -156,42 +220,44 @@ def main():
     logging.info(f"Loading grid from: {GRID_ASSET}")
     grid_fc = ee.FeatureCollection(GRID_ASSET)
     size = grid_fc.size().getInfo()
-    features = grid_fc.toList(size)
-
-    cores = max(1, multiprocessing.cpu_count() - 1)
-
-    for chunk_name, band_list in CHUNKS.items():
-        logging.info(f"Starting download for {chunk_name} ({len(band_list)} bands): {band_list}")
-        out_dir = os.path.join(OUTPUT_DIR, COUNTRY_NAME, YEAR, chunk_name)
-        os.makedirs(out_dir, exist_ok=True)
-
-        existing_files = sorted([
-            int(f.split("_")[-1].replace(".tif", ""))
-            for f in os.listdir(out_dir)
-            if f.endswith(".tif") and f.startswith(f"google_embed_{COUNTRY_NAME}_{YEAR}_{RES}m_")
-        ])
-        start_index = max(existing_files) + 1 if existing_files else 0
+    features = fetch_features(grid_fc, size)
+    epsgs = [utm_epsg(f) for f in features]
 
-        all_params = [
-            (i, features.get(i), band_list, chunk_name)
-            for i in range(start_index, size)
-        ]
-
-        with multiprocessing.Pool(cores) as pool:
-            results = []
-            with tqdm(total=len(all_params), desc=f"Downloading {chunk_name}") as pbar:
-                def update_bar(_):
-                    pbar.update()
-
-                for args in all_params:
-                    res = pool.apply_async(check_and_download, args=(args,), callback=update_bar)
-                    results.append(res)
-
-                results = [r.get() for r in results]
-
-        succeeded = sum(r is not None for r in results)
-        logging.info(f"Chunk {chunk_name}: {succeeded}/{len(all_params)} tiles downloaded successfully.")
+    # One executor (and its warm connections) is shared by every chunk
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    futures = []
+    try:
+        for chunk_name, band_list in CHUNKS.items():
+            logging.info(f"Starting download for {chunk_name} ({len(band_list)} bands): {band_list}")
+            out_dir = os.path.join(OUTPUT_DIR, COUNTRY_NAME, YEAR, chunk_name)
+            os.makedirs(out_dir, exist_ok=True)
+
+            last_index = read_last_index(out_dir, chunk_name)
+            start_progress(out_dir, last_index)
+            start_index = last_index + 1
+
+            all_params = [
+                (i, features[i], epsgs[i], band_list, chunk_name)
+                for i in range(start_index, size)
+            ]
+
+            # Reap tiles as they finish so one slow tile doesn't hold up the rest
+            futures = [executor.submit(check_and_download, p) for p in all_params]
+            results = [
+                fut.result()
+                for fut in tqdm(as_completed(futures), total=len(futures), desc=f"Downloading {chunk_name}")
+            ]
+
+            succeeded = sum(r is not None for r in results)
+            logging.info(f"Chunk {chunk_name}: {succeeded}/{len(all_params)} tiles downloaded successfully.")
+    except BaseException:
+        # Drop queued tiles so Ctrl-C or an error doesn't wait for the whole chunk
+        # (ThreadPoolExecutor.shutdown(cancel_futures=...) needs Python 3.9)
+        for fut in futures:
+            fut.cancel()
+        raise
+    finally:
+        executor.shutdown()
 
 if __name__ == '__main__':
-    multiprocessing.freeze_support()
     main()
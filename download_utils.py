@@ -0,0 +1,127 @@
+# download_utils.py
+# Helpers shared by download.py and gee_embedding_download.py
+import ee
+import requests
+from requests.adapters import HTTPAdapter
+import shutil
+import random
+import threading
+import logging
+
+# ========== Earth Engine Init ==========
+EE_HIGHVOLUME_URL = 'https://earthengine-highvolume.googleapis.com'
+
+def init_ee():
+    # The high-volume endpoint is meant for many small parallel requests
+    try:
+        ee.Initialize(opt_url=EE_HIGHVOLUME_URL)
+    except ee.EEException:
+        ee.Authenticate()
+        ee.Initialize(opt_url=EE_HIGHVOLUME_URL)
+
+# ========== HTTP Session ==========
+def make_session(max_workers):
+    # Downloads are IO-bound and run in threads; urllib3's pool is thread-safe,
+    # so all workers share one keep-alive session.
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=max_workers, max_retries=0))
+    return session
+
+def stream_to_file(session, url, path):
+    with session.get(url, timeout=300, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(r.raw, f, length=1 << 20)
+
+# ========== Retry / Throttling ==========
+THROTTLE_STATUSES = (429, 503)
+
+class AdaptiveLimiter:
+    """Caps concurrent downloads; halves the cap on repeated 429/503s and
+    grows it back by one per successful download."""
+    THROTTLE_THRESHOLD = 3
+
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = limit
+        self.active = 0
+        self.consecutive_429 = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def succeeded(self):
+        with self.cond:
+            self.consecutive_429 = 0
+            if self.limit < self.max_limit:
+                self.limit += 1
+                self.cond.notify()
+
+    def throttled(self):
+        with self.cond:
+            self.consecutive_429 += 1
+            if self.consecutive_429 >= self.THROTTLE_THRESHOLD and self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                self.consecutive_429 = 0
+                logging.info(f"Server is throttling; lowering concurrency to {self.limit}")
+
+def _http_status(e):
+    response = getattr(e, 'response', None)
+    if isinstance(e, requests.HTTPError) and response is not None:
+        return response.status_code
+    return None
+
+def url_rejected(e):
+    # The server refused the URL itself (e.g. it expired), not just throttled us
+    status = _http_status(e)
+    return status is not None and status not in THROTTLE_STATUSES
+
+def retry_wait(e, attempt, limiter, base_wait, max_retries):
+    # Honor Retry-After on 429/503 (capped at the longest backoff we would use
+    # anyway), otherwise use jittered exponential backoff
+    if _http_status(e) in THROTTLE_STATUSES:
+        limiter.throttled()
+        retry_after = e.response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), base_wait * (2**max_retries))
+    return random.uniform(0.5, 1.5) * base_wait * (2**attempt)
+
+# ========== Earth Engine Helpers ==========
+def fetch_features(fc, size, batch_size=5000):
+    # getInfo() refuses collections over 5000 elements, so page through the list
+    features = []
+    for offset in range(0, size, batch_size):
+        features.extend(fc.toList(batch_size, offset).getInfo())
+    return features
+
+def get_download_url(img, feature, epsg, res):
+    # getDownloadURL is a client-side REST call and cannot be mapped inside EE,
+    # so it is generated once per tile and reused across retries.
+    img_utm = img.reproject(f"EPSG:{epsg}", None, res)
+    return img_utm.getDownloadURL({
+        'region': feature.geometry(),
+        'scale': res,
+        'format': 'GEO_TIFF'
+    })
+
+_HOST_LOCK = threading.Lock()
+_host_logged = False
+
+def log_download_host(url):
+    # Logged once per run to confirm downloads go through the high-volume endpoint
+    global _host_logged
+    with _HOST_LOCK:
+        if _host_logged:
+            return
+        _host_logged = True
+    logging.info(f"Download URL host: {url.split('/')[2]}")
@@ -1,14 +1,20 @@
 import ee
 import os
 import sys
-import requests
+from download_utils import (
+    init_ee, make_session, stream_to_file, AdaptiveLimiter,
+    url_rejected, retry_wait, fetch_features, get_download_url, log_download_host
+)
 import rasterio
-import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import time
 import logging
 from pyproj import CRS
 import json
+import functools
+import pickle
+import calendar
 
 # ========== Logging Setup ==========
 class RedFormatter(logging.Formatter):
@@ -41,9 +47,9 @@ except (json.JSONDecodeError, FileNotFoundError) as e:
 
 COUNTRY_NAME = config.get('COUNTRY_NAME') or sys.exit("COUNTRY_NAME missing in config.json")
 UTM_GRID_ASSET = config.get('UTM_GRID_ASSET') or sys.exit("UTM_GRID_ASSET missing in config.json")
-SOUTH = config.get('SOUTH', False)
 MAX_RETRIES = config.get('MAX_RETRIES', 5)
 BASE_WAIT = config.get('BASE_WAIT', 2.0)
+MAX_WORKERS = config.get('MAX_WORKERS', 32)
 
 START_DATE = config['START_DATE']
 END_DATE = config['END_DATE']
@@ -65,23 +71,86 @@ CHUNKS = {
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # ========== Earth Engine Init ==========
-try:
-    ee.Initialize()
-except ee.EEException:
-    ee.Authenticate()
-    ee.Initialize()
+init_ee()
+
+# ========== HTTP Session / Throttling ==========
+_SESSION = make_session(MAX_WORKERS)
+_LIMITER = AdaptiveLimiter(MAX_WORKERS)
 
 # ========== Load AOI and Grid ==========
 country_fc = ee.FeatureCollection('FAO/GAUL/2015/level0').filter(ee.Filter.eq('ADM0_NAME', COUNTRY_NAME))
 utm_grid = ee.FeatureCollection(UTM_GRID_ASSET)
 
+LEGACY_ASSET_PREFIX = 'projects/earthengine-legacy/assets/'
+
+def parse_update_time(ts):
+    # RFC 3339 timestamp from listAssets(), e.g. 2024-05-01T12:34:56.789Z
+    if not ts:
+        return 0.0
+    return float(calendar.timegm(time.strptime(ts[:19], "%Y-%m-%dT%H:%M:%S")))
+
+@functools.lru_cache(maxsize=None)
+def list_assets():
+    # One listing of ASSET_FOLDER replaces a getAsset() call per zone.
+    # Maps every known form of each asset ID to its update time.
+    assets = {}
+    params = {'parent': ASSET_FOLDER.rstrip('/')}
+    try:
+        while True:
+            resp = ee.data.listAssets(params)
+            for a in resp.get('assets', []):
+                updated = parse_update_time(a.get('updateTime'))
+                # Legacy folders (users/...) report name as
+                # projects/earthengine-legacy/assets/users/..., so keep the id too
+                assets[a['name']] = updated
+                if a.get('id'):
+                    assets[a['id']] = updated
+                if a['name'].startswith(LEGACY_ASSET_PREFIX):
+                    assets[a['name'][len(LEGACY_ASSET_PREFIX):]] = updated
+            if not resp.get('nextPageToken'):
+                return assets
+            params['pageToken'] = resp['nextPageToken']
+    except ee.EEException as e:
+        logging.error(f"Could not list {ASSET_FOLDER}, falling back to getAsset() per zone: {e}")
+        return None
+
+@functools.lru_cache(maxsize=None)
 def asset_exists(aid):
+    assets = list_assets()
+    if assets is not None:
+        return aid in assets
     try:
         ee.data.getAsset(aid)
         return True
     except ee.EEException:
         return False
 
+def asset_update_time(aid):
+    # None if unknown (listing failed); inf if the asset was not listed, i.e.
+    # it was exported during this run
+    assets = list_assets()
+    if assets is None:
+        return None
+    return assets.get(aid, float('inf'))
+
+TASK_DONE_STATES = {'COMPLETED', 'FAILED', 'CANCELLED'}
+
+def wait_for_task(task, zone):
+    # Poll quickly for short exports and back off for long ones. active() is
+    # also False for UNKNOWN/UNSUBMITTED tasks, so the loop cannot hang on them.
+    delay = 2.0
+    state = None
+    while task.active():
+        logging.info(f"    Waiting for export of zone {zone}…")
+        time.sleep(delay)
+        delay = min(60.0, delay * 1.5)
+        state = task.status()['state']
+        if state in TASK_DONE_STATES:
+            break
+    if state not in TASK_DONE_STATES:
+        state = task.status()['state']
+    return state
+
 def export_zone_grids():
     logging.info("Starting export of per-zone grids…")
     utm_zone = utm_grid.filterBounds(country_fc)
@@ -92,13 +161,19 @@ def export_zone_grids():
         zone_poly = utm_grid.filter(ee.Filter.eq('ZONE', zone)).geometry()
         clipped = country_fc.geometry().intersection(zone_poly, 1)
         try:
-            area_sq_m = clipped.area().getInfo()
+            # Area and centroid come back in the same request
+            stats = ee.Dictionary({
+                'area': clipped.area(),
+                'centroid': clipped.centroid(1).coordinates()
+            }).getInfo()
         except Exception as e:
             logging.error(f"Error computing area for zone {zone}: {e}")
             continue
-        if area_sq_m == 0:
+        if stats['area'] == 0:
             continue
-        epsg = int(CRS.from_dict({'proj':'utm','zone':zone,'south':SOUTH}).to_authority()[1])
+        # Hemisphere is taken per zone so cross-equator countries get the right UTM
+        south = stats['centroid'][1] < 0
+        epsg = int(CRS.from_dict({'proj':'utm','zone':zone,'south':south}).to_authority()[1])
         crs = f"EPSG:{epsg}"
         grid = clipped.coveringGrid(crs, GRID_SIZE).map(lambda feat: feat.buffer(distance=-1)).map(lambda f: f.set('ZONE', zone))
         asset_id = f"{ASSET_FOLDER}{COUNTRY_NAME}_utm_grid_{GRID_SIZE}m_zone{zone}"
@@ -110,13 +185,14 @@ def export_zone_grids():
                 assetId=asset_id
             )
             task.start()
-            while task.active():
-                logging.info(f"    Waiting for export of zone {zone}…")
-                time.sleep(10)
+            state = wait_for_task(task, zone)
+            if state != 'COMPLETED':
+                logging.error(f"  Export of zone {zone} ended with state {state}; skipping zone.")
+                continue
             logging.info(f"  Export of zone {zone} completed.")
         else:
             logging.info(f"  Asset {asset_id} already exists, skipping export.")
-        zone_info.append((zone, epsg, crs, asset_id))
+        zone_info.append((zone, epsg, crs, asset_id, south))
     if not zone_info:
         logging.error("No UTM zones found; exiting.")
         sys.exit(1)
@@ -124,89 +200,141 @@ def export_zone_grids():
     return zone_info
 
 # ========== Get Embedding Image with Label ==========
-def get_embedding_image(feature, epsg, band_list):
-    geometry = feature.geometry()
+# Built once for all bands so every tile and band chunk shares the same
+# server-side graph; chunks only differ by a final select().
+EMBEDDING_MEAN = ee.ImageCollection("GOOGLE/SATELLITE_EMBEDDING/V1/ANNUAL") \
+    .filter(ee.Filter.calendarRange(int(YEAR), int(YEAR), 'year')) \
+    .mean() \
+    .multiply(10000).toInt16()
 
-    collection = ee.ImageCollection("GOOGLE/SATELLITE_EMBEDDING/V1/ANNUAL") \
-        .filter(ee.Filter.calendarRange(int(YEAR), int(YEAR), 'year'))
+WETLAND_LABEL = ee.Image("projects/ee-gmkovacs/assets/ext_wetland_2018_v2021_nw") \
+    .select([0], ['wetland_label']) \
+    .toInt16()
 
-    embedding = collection.select(band_list).mean() \
-        .clip(geometry) \
-        .multiply(10000).toInt16()
+def get_embedding_image(feature, epsg, band_list):
+    geometry = feature.geometry()
 
-    label = ee.Image("projects/ee-gmkovacs/assets/ext_wetland_2018_v2021_nw") \
-        .clip(geometry) \
-        .select([0], ['wetland_label']) \
-        .toInt16()
+    embedding = EMBEDDING_MEAN.select(band_list).clip(geometry)
+    label = WETLAND_LABEL.clip(geometry)
 
     return label.addBands(embedding), epsg
 
 
 # ========== Download Function ==========
 def download_images(params):
-    feat, idx, epsg, band_list, chunk_name = params
-    feature = feat.transform(f'EPSG:{epsg}', 0.001)
-    try:
-        img, epsg = get_embedding_image(feature, epsg, band_list)
-    except Exception as e:
-        logging.error(f"Failed to get embedding image: {e}")
-        return None
+    feature_obj, idx, epsg, band_list, chunk_name = params
 
+    # Check for an existing tile before building any EE objects
     out_dir = os.path.join(OUTPUT_DIR, COUNTRY_NAME, YEAR, chunk_name)
-    os.makedirs(out_dir, exist_ok=True)
     filename = f"google_embed_{COUNTRY_NAME}_{YEAR}_{RES}m_{epsg}_{chunk_name}_{idx}.tif"
     outp = os.path.join(out_dir, filename)
 
     if os.path.exists(outp):
         return outp
 
+    os.makedirs(out_dir, exist_ok=True)
+    try:
+        feature = ee.Feature(feature_obj)
+        img, epsg = get_embedding_image(feature, epsg, band_list)
+    except Exception as e:
+        logging.error(f"Failed to get embedding image: {e}")
+        return None
+
+    # Write to a .part file so an interrupted download never looks complete
+    part = outp + ".part"
+    url = None
     for i in range(MAX_RETRIES):
+        _LIMITER.acquire()
         try:
-            img_utm = img.reproject(f'EPSG:{epsg}', None, RES)
-            url = img_utm.getDownloadURL({
-                'region': feature.geometry(),
-                'scale': RES,
-                'format': 'GEO_TIFF'
-            })
-            r = requests.get(url, timeout=300)
-            r.raise_for_status()
-            with open(outp, 'wb') as f:
-                f.write(r.content)
-            with rasterio.open(outp, 'r+') as dst:
-                dst.set_band_description(1, "wetland_label")
-                for bi in range(2, dst.count + 1):
-                    dst.set_band_description(bi, f"embedding_{bi-2}")
+            if url is None:
+                url = get_download_url(img, feature, epsg, RES)
+                log_download_host(url)
+            stream_to_file(_SESSION, url, part)
+            with rasterio.open(part, 'r+', sharing=False) as dst:
+                dst.descriptions = tuple(["wetland_label"] + [f"embedding_{k}" for k in range(dst.count - 1)])
+            os.replace(part, outp)
             if idx == 0:
                 with open(os.path.join(out_dir, "bands_used.txt"), "w") as f:
                     f.write("\n".join(band_list))
+            _LIMITER.succeeded()
             return outp
         except Exception as e:
+            if os.path.exists(part):
+                os.remove(part)
+            if url_rejected(e):
+                # The server rejected the URL (e.g. it expired); request a fresh one
+                url = None
             logging.warning(f"    Retry {i+1}/{MAX_RETRIES} failed: {e}")
-            time.sleep(BASE_WAIT * (2**i))
+            wait = retry_wait(e, i, _LIMITER, BASE_WAIT, MAX_RETRIES)
+        finally:
+            _LIMITER.release()
+        time.sleep(wait)
     logging.error(f"Failed to download after retries: {filename}")
     return None
 
 
+# ========== Zone Feature Cache ==========
+
+def load_zone_features(zone_info):
+    # Zone grids are fixed once exported, so fetch each one once and pickle it
+    cache_path = os.path.join(OUTPUT_DIR, f"{COUNTRY_NAME}_zone_features.pkl")
+    zone_features = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                zone_features = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError) as e:
+            logging.info(f"Ignoring unreadable cache {cache_path}: {e}")
+
+        # Drop zones whose grid asset was re-exported after the cache was written
+        cache_mtime = os.path.getmtime(cache_path)
+        for _, _, _, aid, _ in zone_info:
+            updated = asset_update_time(aid)
+            if aid in zone_features and updated is not None and updated > cache_mtime:
+                logging.info(f"  Cached features for {aid} are stale, refetching")
+                del zone_features[aid]
+
+    missing = [aid for _, _, _, aid, _ in zone_info if aid not in zone_features]
+    for aid in missing:
+        logging.info(f"  Fetching features for {aid}")
+        fc = ee.FeatureCollection(aid)
+        zone_features[aid] = fetch_features(fc, fc.size().getInfo())
+    if missing:
+        with open(cache_path + ".tmp", 'wb') as f:
+            pickle.dump(zone_features, f)
+        os.replace(cache_path + ".tmp", cache_path)
+    return zone_features
+
+
 # ========== Main ==========
 def main():
     zone_info = export_zone_grids()
-    cores = max(1, multiprocessing.cpu_count() - 1)
-
-    for chunk_name, band_list in CHUNKS.items():
-        logging.info(f"Starting download for {chunk_name} ({len(band_list)} bands): {band_list}")
+    zone_features = load_zone_features(zone_info)
+    # One executor (and its warm connections) is shared by every chunk and zone
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    futures = []
+    try:
+        for chunk_name, band_list in CHUNKS.items():
+            logging.info(f"Starting download for {chunk_name} ({len(band_list)} bands): {band_list}")
 
-        for zone, epsg, crs, aid in zone_info:
-            fc = ee.FeatureCollection(aid)
-            lst = fc.toList(fc.size()).getInfo()
-            params = [(ee.Feature(lst[i]), i, epsg, band_list, chunk_name) for i in range(len(lst))]
+            for zone, epsg, crs, aid, south in zone_info:
+                lst = zone_features[aid]
+                params = [(lst[i], i, epsg, band_list, chunk_name) for i in range(len(lst))]
 
-            logging.info(f"  Total tasks for zone {zone}, {chunk_name}: {len(params)}")
-            with multiprocessing.Pool(cores) as pool:
-                results = list(tqdm(pool.imap(download_images, params), total=len(params)))
-            succeeded = sum(r is not None for r in results)
-            logging.info(f"Zone {zone} ({chunk_name}): {succeeded}/{len(params)} succeeded.")
+                logging.info(f"  Total tasks for zone {zone}, {chunk_name}: {len(params)}")
+                futures = [executor.submit(download_images, p) for p in params]
+                results = [fut.result() for fut in tqdm(as_completed(futures), total=len(futures))]
+                succeeded = sum(r is not None for r in results)
+                logging.info(f"Zone {zone} ({chunk_name}): {succeeded}/{len(params)} succeeded.")
+    except BaseException:
+        # Drop queued tiles so Ctrl-C or an error doesn't wait for the whole chunk
+        # (ThreadPoolExecutor.shutdown(cancel_futures=...) needs Python 3.9)
+        for fut in futures:
+            fut.cancel()
+        raise
+    finally:
+        executor.shutdown()
 
 
 if __name__ == '__main__':
-    multiprocessing.freeze_support()
     main()
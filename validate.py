@@ -1,11 +1,14 @@
 # validate_and_delete.py
 import os
 import json
+import re
+import sqlite3
 import rasterio
 import logging
 import warnings
 from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
 
 # ========== Environment Suppression ==========
 os.environ["CPL_LOG"] = "OFF"
@@ -20,6 +23,9 @@ logging.getLogger("fiona").setLevel(logging.ERROR)
 # ========== Settings ==========
 CONFIG_PATH = "config.json"
 EXPECTED_LABEL_BANDS = 1
+CACHE_NAME = "validation_cache.sqlite"
+LAST_INDEX_FILE = "_last_index"
+TILE_INDEX_RE = re.compile(r"_(\d+)\.tif$")
 
 # ========== Load Config ==========
 with open(CONFIG_PATH, "r") as f:
@@ -51,6 +57,49 @@ handler = logging.StreamHandler()
 handler.setFormatter(RedFormatter('%(asctime)s - %(levelname)s - %(message)s'))
 logging.basicConfig(handlers=[handler], level=logging.INFO)
 
+# ========== Validation Cache ==========
+def open_cache():
+    # Files that already passed are skipped while their mtime and size are unchanged
+    conn = sqlite3.connect(os.path.join(OUTPUT_DIR, CACHE_NAME))
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS validated "
+        "(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, count INTEGER)"
+    )
+    return conn
+
+def load_cache(conn):
+    return {
+        path: (mtime, size, count)
+        for path, mtime, size, count in conn.execute("SELECT path, mtime, size, count FROM validated")
+    }
+
+def record_passed(conn, rows):
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO validated VALUES (?, ?, ?, ?)", rows)
+
+# ========== Resume Marker ==========
+def rewind_last_index(chunk_dir, deleted_paths):
+    # download.py resumes after _last_index; move it back before the first
+    # deleted tile so the download step picks the deleted tiles up again.
+    marker = os.path.join(chunk_dir, LAST_INDEX_FILE)
+    if not os.path.exists(marker):
+        return
+    indices = [int(m.group(1)) for m in (TILE_INDEX_RE.search(p) for p in deleted_paths) if m]
+    if not indices:
+        return
+    try:
+        with open(marker, "r") as f:
+            last_index = int(f.read())
+    except ValueError:
+        os.remove(marker)
+        return
+    new_index = min(indices) - 1
+    if new_index < last_index:
+        with open(marker + ".tmp", "w") as f:
+            f.write(str(new_index))
+        os.replace(marker + ".tmp", marker)
+        logging.info(f"Rewound {marker} from {last_index} to {new_index}.")
+
 # ========== Validation Function ==========
 def validate_file(args):
     full_path, expected_bands = args
@@ -67,6 +116,9 @@ def validate_file(args):
 # ========== Main ==========
 def main():
     cores = max(1, cpu_count() - 1)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    conn = open_cache()
+    cache = load_cache(conn)
 
     for chunk_name, bands in CHUNKS.items():
         expected_bands = EXPECTED_LABEL_BANDS + len(bands)
@@ -76,30 +128,52 @@ def main():
             logging.warning(f"{chunk_dir} does not exist.")
             continue
 
-        tif_files = sorted([
-            os.path.join(chunk_dir, f) for f in os.listdir(chunk_dir)
-            if f.endswith(".tif")
-        ])
-
-        with Pool(cores) as pool:
+        tif_files = []
+        stats = {}
+        skipped = 0
+        for entry in os.scandir(chunk_dir):
+            if not entry.name.endswith(".tif"):
+                continue
+            st = entry.stat()
+            stats[entry.path] = (st.st_mtime, st.st_size, expected_bands)
+            if cache.get(entry.path) == stats[entry.path]:
+                skipped += 1
+            else:
+                tif_files.append(entry.path)
+        tif_files.sort()
+        logging.info(f"{chunk_name}: {skipped} files unchanged since last validation, skipping.")
+
+        # GDAL releases the GIL while opening, so threads scale like processes
+        with ThreadPoolExecutor(max_workers=min(64, cores * 4)) as executor:
             results = list(tqdm(
-                pool.imap(validate_file, [(f, expected_bands) for f in tif_files]),
+                executor.map(validate_file, [(f, expected_bands) for f in tif_files]),
                 total=len(tif_files),
                 desc=f"Deleting invalid in {chunk_name}",
                 unit="file"
             ))
 
+        record_passed(conn, [
+            (path,) + stats[path]
+            for path, result in zip(tif_files, results)
+            if result is None
+        ])
+
         deleted = 0
+        deleted_paths = []
         for path in results:
             if path is not None and os.path.exists(path):
                 try:
                     os.remove(path)
                     deleted += 1
+                    deleted_paths.append(path)
                     logging.warning(f"Deleted invalid file: {path}")
                 except Exception as e:
                     logging.error(f"Failed to delete {path}: {e}")
 
         logging.info(f"{chunk_name}: {deleted} invalid or corrupted files deleted.")
+        rewind_last_index(chunk_dir, deleted_paths)
+
+    conn.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file